@@ -2,68 +2,60 @@
 """ Generates a list of media available in Emby and their seen status for each profile """
 
 from dataclasses import dataclass
-from typing import Optional
+from operator import itemgetter
 import sys
 import os
 import argparse
-import requests
+import asyncio
+import aiohttp
 import yaml
 
+try:
+    # The libyaml-backed loader parses the config much faster than the
+    # pure-Python one and is not always compiled in
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
-@dataclass
-class EmbyProfile:
-    """ An Emby profile. For now, find these in the web UI when inspecting the user's profile """
-    name: str
-    id: str
-
-
-class EmbyItem:
-    """ The default Emby item (movie probably)"""
-    name: str
-    id: int
-    seen_by: Optional[list] = []
-
-    def __init__(self, item_data: dict, profile: EmbyProfile):
-        self.name = item_data['Name']
-        self.id = item_data['Id']
-        self.profile = profile
-        if item_data['UserData']['Played']:
-            self.seen_by = [profile.name]
-        else:
-            self.seen_by = []
+try:
+    # orjson parses the large /Items payloads several times faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-    @classmethod
-    def create_from_dict(cls, item_data: dict, profile: EmbyProfile) -> 'EmbyItem':
-        """ Initialize an item from a dict """
+try:
+    # ijson lets us decode /Items pages incrementally as the bytes arrive
+    import ijson
+except ImportError:
+    ijson = None
 
-        if item_data['Type'] == 'Episode':
-            return EmbyEpisode(item_data=item_data, profile=profile)
+# Only the fields the merge/display code actually reads; trimming the rest
+# (and disabling images) shrinks the /Items payloads considerably.
+ITEM_FIELDS = 'Name,Id,SeriesId,ParentIndexNumber,SeasonName,IndexNumber'
+PAGE_SIZE = 1000
 
-        if item_data['Type'] == 'Series':
-            return EmbySeries(item_data=item_data, profile=profile)
-
-        return cls(item_data=item_data, profile=profile)
 
+@dataclass(slots=True)
+class EmbyProfile:
+    """ An Emby profile. For now, find these in the web UI when inspecting the user's profile """
+    name: str
+    id: str
+    bit: int = 0
 
-class EmbyEpisode(EmbyItem):
-    """ An Emby episode """
 
-    def __init__(self, item_data: dict, profile: EmbyProfile):
-        self.series_id = item_data['SeriesId']
-        if 'ParentIndexNumber' in item_data:
-            self.season = item_data['ParentIndexNumber']
-        else:
-            self.season = 0
-        self.season_name = item_data['SeasonName']
-        self.episode = item_data['IndexNumber']
-        super().__init__(item_data=item_data, profile=profile)
+# Field offsets into the compact item rows built by parse_item; the item ID
+# is not repeated in the row since it is the catalog key
+I_NAME, I_SERIES_ID, I_SEASON, I_SEASON_NAME, I_EPISODE, I_SEEN = range(6)
 
 
-class EmbySeries(EmbyItem):
-    """ An Emby series """
+def parse_item(item_data: dict) -> list:
+    """ Parse a raw Emby item into a compact fixed-layout row """
+    if item_data['Type'] == 'Episode':
+        return [item_data['Name'], item_data['SeriesId'],
+                item_data.get('ParentIndexNumber', 0),
+                item_data['SeasonName'], item_data['IndexNumber'], 0]
 
-    def __init__(self, item_data: dict, profile: EmbyProfile):
-        super().__init__(item_data=item_data, profile=profile)
+    return [item_data['Name'], None, 0, '', 0, 0]
 
 
 class EmbySeen:
@@ -73,140 +65,218 @@ class EmbySeen:
         self.config = config
         self.host = self.config['emby']['host']
         self.api_key = self.config['emby']['api_key']
+        self._hide_episodes = frozenset(self.config.get('hide_episodes', []))
         self.profiles = []
         self.output = []
         self.output_title_max_len = 0
-        self.names = []
-        self.output_names_max_len = 0
-        self.get_profiles()
 
-    def get_profiles(self):
+    async def get_profiles(self, session: aiohttp.ClientSession):
         """ Get the list of users """
-        re = requests.get(
-            f"{self.host}/Users?api_key={self.api_key}",
-            timeout=10)
-
-        re.raise_for_status()
+        async with session.get(f"{self.host}/Users?api_key={self.api_key}") as re:
+            re.raise_for_status()
+            user_list = json_loads(await re.read())
 
-        for user_data in re.json():
+        for idx, user_data in enumerate(user_list):
             self.profiles.append(
-                EmbyProfile(name=user_data['Name'], id=user_data['Id'])
+                EmbyProfile(name=user_data['Name'], id=user_data['Id'],
+                            bit=1 << idx)
             )
 
     def output_append(self, item):
         """ Append an item to the output list """
         self.output_title_max_len = max(
             self.output_title_max_len, len(item[1]))
-        for name in item[2]:
-            if name not in self.names:
-                self.names.append(name)
-                self.output_names_max_len = max(
-                    self.output_names_max_len, len(name))
-
         self.output.append(item)
 
     def display_output(self):
         """ Display the output list """
 
-        print(f"┏{'━'*9}┳{'━' * (self.output_title_max_len+2)}", end="")
-        for _ in self.names:
-            print(f"┳{'━' * (self.output_names_max_len+2)}", end="")
-        print("┓")
-
-        print(f"┃ Type    ┃ {'Title':{self.output_title_max_len}}", end="")
-        for name in self.names:
-            print(f" ┃ {name:{self.output_names_max_len}}", end="")
-        print(" ┃")
+        # As before, only profiles whose bit is set on at least one item
+        # get a column
+        seen_union = 0
+        for item in self.output:
+            seen_union |= item[2]
+        name_bits = [(profile.name, profile.bit)
+                     for profile in self.profiles if profile.bit & seen_union]
+        names_max_len = max((len(name) for name, _ in name_bits), default=0)
+
+        # Build the whole table in memory and emit it with a single write
+        # rather than one print call per cell. The column widths are fixed
+        # by now, so bind the pad-to-width formatters once instead of
+        # re-parsing a dynamic format spec for every cell
+        parts = []
+        tfmt = ('{:<%d}' % self.output_title_max_len).format
+        nfmt = ('{:<%d}' % names_max_len).format
+        blank_name = ' ' * names_max_len
+
+        # The separator lines are identical for every row, so build each of
+        # them exactly once
+        title_bar = '━' * (self.output_title_max_len + 2)
+        name_bar = '━' * (names_max_len + 2)
+        top = f"┏{'━'*9}┳{title_bar}" + f"┳{name_bar}" * len(name_bits) + "┓\n"
+        mid = f"┣{'━'*9}╋{title_bar}" + f"╋{name_bar}" * len(name_bits) + "┫\n"
+        bot = f"┗{'━'*9}┻{title_bar}" + f"┻{name_bar}" * len(name_bits) + "┛\n"
+
+        parts.append(top)
+
+        parts.append(f"┃ Type    ┃ {tfmt('Title')}")
+        for name, _ in name_bits:
+            parts.append(f" ┃ {nfmt(name)}")
+        parts.append(" ┃\n")
 
         for item in self.output:
 
-            print(f"┣{'━'*9}╋{'━' * (self.output_title_max_len+2)}", end="")
-            for _ in self.names:
-                print(f"╋{'━' * (self.output_names_max_len+2)}", end="")
-            print("┫")
+            parts.append(mid)
 
-            print(f"┃ {item[0]:7} ┃ {
-                  item[1]:{self.output_title_max_len}}", end="")
+            parts.append(f"┃ {item[0]:7} ┃ {tfmt(item[1])}")
 
-            for name in self.names:
-                if name in item[2]:
-                    print(f" ┃ {name:{self.output_names_max_len}}", end="")
+            for name, bit in name_bits:
+                if item[2] & bit:
+                    parts.append(f" ┃ {nfmt(name)}")
                 else:
-                    print(f" ┃ {'':{self.output_names_max_len}}", end="")
-            print(" ┃")
+                    parts.append(f" ┃ {blank_name}")
+            parts.append(" ┃\n")
 
-        print(f"┗{'━'*9}┻{'━' * (self.output_title_max_len+2)}", end="")
-        for _ in self.names:
-            print(f"┻{'━' * (self.output_names_max_len+2)}", end="")
-        print("┛")
-
-    def get_media_list(self):
-        """ Get a list of media available in Emby for each profile """
-        movies, series, episodes = {}, {}, {}
-        for profile in self.profiles:
+        parts.append(bot)
 
-            print(f"Getting media list for {
-                  profile.name}...", file=sys.stderr, flush=True, end="")
-            re = requests.get(
-                f"{self.host}/Users/{profile.id}/Items?" +
-                "IncludeItemTypes=Movie,Series,Episode&" +
-                f"Recursive=true&StartIndex=0&api_key={self.api_key}",
-                timeout=10)
-            print(" ", end="", file=sys.stderr, flush=True)
+        sys.stdout.write("".join(parts))
 
+    async def _fetch_total(self, session: aiohttp.ClientSession, url: str) -> int:
+        """ Ask how many records an /Items query matches, without the records """
+        async with session.get(f"{url}&Limit=0") as re:
             re.raise_for_status()
+            return json_loads(await re.read())['TotalRecordCount']
 
-            print("", file=sys.stderr, flush=True)
-
-            for item_data in re.json()['Items']:
-
-                # print(item_data)
+    async def _fetch_page(self, session: aiohttp.ClientSession, url: str,
+                          start_index: int) -> list:
+        """ Fetch the items of one page of an /Items query """
+        async with session.get(
+                f"{url}&StartIndex={start_index}&Limit={PAGE_SIZE}") as re:
+            re.raise_for_status()
+            if ijson is None:
+                return json_loads(await re.read())['Items']
+            # Decode incrementally so a page's raw bytes are never held in
+            # memory alongside its parsed items
+            return [item_data async for item_data
+                    in ijson.items(re.content, 'Items.item')]
+
+    async def _fetch_pages(self, session: aiohttp.ClientSession, url: str) -> list:
+        """ Fetch every page of an /Items query and concatenate them """
+        total = await self._fetch_total(session, url)
+
+        # The pages are independent, so fetch them concurrently
+        items = []
+        for page in await asyncio.gather(
+                *[self._fetch_page(session, url, start_index)
+                  for start_index in range(0, total, PAGE_SIZE)]):
+            items.extend(page)
+
+        return items
+
+    async def _fetch_catalog(self, session: aiohttp.ClientSession) -> tuple:
+        """ Fetch the full media catalog once, keyed by item ID and split by type """
+        url = (
+            f"{self.host}/Items?" +
+            "IncludeItemTypes=Movie,Series,Episode&" +
+            f"Recursive=true&Fields={ITEM_FIELDS}&" +
+            "EnableImages=false&ImageTypeLimit=0&" +
+            f"api_key={self.api_key}")
+
+        catalog = {}
+        buckets = {'Movie': {}, 'Series': {}, 'Episode': {}}
+        for item_data in await self._fetch_pages(session, url):
+            # Check before parsing so duplicates (e.g. an item repeated
+            # across page boundaries) cost a dict probe, not an allocation
+            item_id = item_data['Id']
+            if item_id not in catalog:
+                row = parse_item(item_data)
+                catalog[item_id] = row
+                buckets[item_data['Type']][item_id] = row
+
+        return catalog, buckets
+
+    async def _fetch_played_ids(self, session: aiohttp.ClientSession,
+                                profile: EmbyProfile) -> set:
+        """ Fetch the set of item IDs the profile has marked as played """
+        url = (
+            f"{self.host}/Users/{profile.id}/Items?" +
+            "IncludeItemTypes=Movie,Series,Episode&" +
+            "Recursive=true&Filters=IsPlayed&Fields=Id&" +
+            "EnableImages=false&ImageTypeLimit=0&" +
+            f"api_key={self.api_key}")
+
+        try:
+            return {item_data['Id']
+                    for item_data in await self._fetch_pages(session, url)}
+        except aiohttp.ClientResponseError:
+            # Some servers reject Filters=IsPlayed; fall back to pulling the
+            # whole per-profile listing and filtering client-side
+            url = (
+                f"{self.host}/Users/{profile.id}/Items?" +
+                "IncludeItemTypes=Movie,Series,Episode&" +
+                "Recursive=true&Fields=Id&EnableUserData=true&" +
+                "EnableImages=false&ImageTypeLimit=0&" +
+                f"api_key={self.api_key}")
+            return {item_data['Id']
+                    for item_data in await self._fetch_pages(session, url)
+                    if item_data['UserData']['Played']}
+
+    async def get_media_list(self):
+        """ Get a list of media available in Emby for each profile """
 
-                item = EmbyItem.create_from_dict(
-                    item_data=item_data, profile=profile
-                )
+        # One session for every request in the run: connections are pooled
+        # and kept alive, so only the first request per host pays the
+        # TCP/TLS handshake
+        async with aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=16),
+                timeout=aiohttp.ClientTimeout(total=10)) as session:
+            await self.get_profiles(session)
+            print(f"Getting the media catalog and played items for {
+                  len(self.profiles)} profiles...", file=sys.stderr)
+            (catalog, buckets), *played_id_sets = await asyncio.gather(
+                self._fetch_catalog(session),
+                *[self._fetch_played_ids(session, profile)
+                  for profile in self.profiles]
+            )
 
-                if item.__class__ == EmbyEpisode:
-                    if item.id in episodes:
-                        if item.seen_by:
-                            episodes[item.id].seen_by.append(profile.name)
-                    else:
-                        episodes[item.id] = item
-                elif item.__class__ == EmbySeries:
-                    if item.id in series:
-                        if item.seen_by:
-                            series[item.id].seen_by.append(profile.name)
-                    else:
-                        series[item.id] = item
-                else:
-                    if item.id in movies:
-                        if item.seen_by:
-                            movies[item.id].seen_by.append(profile.name)
-                    else:
-                        movies[item.id] = item
+        for profile, played_ids in zip(self.profiles, played_id_sets):
+            # Intersecting with the catalog keys up front keeps the per-ID
+            # work in C and drops stale IDs without a per-item None check
+            for item_id in played_ids & catalog.keys():
+                catalog[item_id][I_SEEN] |= profile.bit
+
+        movies = buckets['Movie']
+        series = buckets['Series']
+        episodes = buckets['Episode']
+
+        # Decorate-sort-undecorate: the series lookup happens once per
+        # episode instead of twice per comparison, and plain tuples sort
+        # without a key function
+        decorated = [
+            (series[e[I_SERIES_ID]][I_NAME], e[I_SEASON], e[I_SEASON_NAME],
+             e[I_EPISODE], item_id, e)
+            for item_id, e in episodes.items()
+        ]
+        decorated.sort()
 
         s = ""
 
-        for _, e in sorted(
-            episodes.items(), key=lambda x: (
-                series[x[1].series_id].name, x[1].season, x[1].season_name, x[1].episode
-            )
-        ):
+        for series_name, season, _, episode, _, e in decorated:
 
-            if s != series[e.series_id].name:
-                s = series[e.series_id].name
-                self.output_append(["Series", s, series[e.series_id].seen_by])
+            if s != series_name:
+                s = series_name
+                self.output_append(
+                    ["Series", s, series[e[I_SERIES_ID]][I_SEEN]])
 
-            if s not in self.config['hide_episodes']:
+            if s not in self._hide_episodes:
                 self.output_append([
                     "Episode",
-                    f"{series[e.series_id].name} [{
-                        e.season:02d}x{e.episode:02d}] {e.name}",
-                    e.seen_by
+                    f"{series_name} [{season:02d}x{episode:02d}] {e[I_NAME]}",
+                    e[I_SEEN]
                 ])
 
-        for _, m in sorted(movies.items(), key=lambda x: x[1].name):
-            self.output_append(["Movie", m.name, m.seen_by])
+        for m in sorted(movies.values(), key=itemgetter(I_NAME)):
+            self.output_append(["Movie", m[I_NAME], m[I_SEEN]])
 
 
 if __name__ == '__main__':
@@ -240,7 +310,7 @@ if __name__ == '__main__':
     if config_file is not None:
 
         with open(file=config_file, mode='r', encoding='utf-8') as f:
-            c = yaml.safe_load(f)
+            c = yaml.load(f, Loader=YamlLoader)
 
     if args.server_url:
         c['emby']['host'] = args.server_url
@@ -258,7 +328,7 @@ if __name__ == '__main__':
 
     try:
         seen = EmbySeen(c)
-        seen.get_media_list()
+        asyncio.run(seen.get_media_list())
         seen.display_output()
     except (BrokenPipeError, KeyboardInterrupt):
         pass